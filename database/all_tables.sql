@@ -748,7 +748,7 @@ CREATE INDEX IF NOT EXISTS idx_order_history_c_time ON order_history(c_time DESC
 CREATE INDEX IF NOT EXISTS idx_order_history_u_time ON order_history(u_time DESC);
 CREATE INDEX IF NOT EXISTS idx_order_history_symbol_time ON order_history(symbol, c_time DESC);
 CREATE INDEX IF NOT EXISTS idx_order_history_inst_id_time ON order_history(inst_id, c_time DESC);
-CREATE INDEX IF NOT EXISTS idx_order_history_cl_ord_id ON order_history(cl_ord_id);
+CREATE INDEX IF NOT EXISTS idx_order_history_cl_ord_id_c_time ON order_history(cl_ord_id, c_time);
 -- 添加fill_time相关索引（用于cl_ord_id匹配查询优化）
 CREATE INDEX IF NOT EXISTS idx_order_history_fill_time ON order_history(fill_time DESC) WHERE fill_time IS NOT NULL;
 CREATE INDEX IF NOT EXISTS idx_order_history_symbol_pos_side_fill_time ON order_history(symbol, pos_side, fill_time DESC) WHERE fill_time IS NOT NULL;
@@ -946,6 +946,7 @@ CREATE INDEX IF NOT EXISTS idx_trading_relations_ord_id ON trading_relations(ord
 CREATE INDEX IF NOT EXISTS idx_trading_relations_position_history_id ON trading_relations(position_history_id);
 CREATE INDEX IF NOT EXISTS idx_trading_relations_operation_type ON trading_relations(operation_type);
 CREATE INDEX IF NOT EXISTS idx_trading_relations_signal_cl_ord ON trading_relations(signal_id, cl_ord_id);
+CREATE INDEX IF NOT EXISTS idx_trading_relations_signal_created ON trading_relations(signal_id, created_at);
 
 -- 表注释
 COMMENT ON TABLE trading_relations IS '交易关联表，记录完整的交易链路：信号ID -> clOrdId -> 多个订单ID -> 持仓ID';
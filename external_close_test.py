@@ -6,9 +6,10 @@
 外部平仓直接调用OKX API，不写业务逻辑
 """
 from pickle import TRUE
+import orjson
 import requests
+import threading
 import time
-import json
 from typing import Optional, Dict, Any, List, Callable
 from dataclasses import dataclass
 from enum import Enum
@@ -96,7 +97,7 @@ class TradingTestClient:
             "signal_id": signal_id
         }
         response = self.session.post(url, json=data)
-        result = response.json()
+        result = orjson.loads(response.content)
         if result.get("status") != "success":
             raise Exception(f"开仓失败: {result}")
         return result
@@ -106,7 +107,7 @@ class TradingTestClient:
         url = f"{self.base_url}/trading/add-position"
         data = {"cl_ord_id": cl_ord_id, "amount": amount}
         response = self.session.post(url, json=data)
-        result = response.json()
+        result = orjson.loads(response.content)
         if result.get("status") != "success":
             raise Exception(f"加仓失败: {result}")
         return result
@@ -116,7 +117,7 @@ class TradingTestClient:
         url = f"{self.base_url}/trading/reduce-position"
         data = {"cl_ord_id": cl_ord_id, "amount": amount}
         response = self.session.post(url, json=data)
-        result = response.json()
+        result = orjson.loads(response.content)
         if result.get("status") != "success":
             raise Exception(f"减仓失败: {result}")
         return result
@@ -126,7 +127,7 @@ class TradingTestClient:
         url = f"{self.base_url}/trading/close-position"
         data = {"cl_ord_id": cl_ord_id, "amount": amount}
         response = self.session.post(url, json=data)
-        result = response.json()
+        result = orjson.loads(response.content)
         if result.get("status") != "success":
             raise Exception(f"平仓失败: {result}")
         return result
@@ -137,10 +138,23 @@ class ExternalCloseClient:
     
     def __init__(self):
         self.api_manager = APIManager()
-        self.api_manager.start()
+        # 延迟启动：首次查询/平仓时才启动API管理器工作线程
+        self._started = False
+        self._start_lock = threading.Lock()
+    
+    def _ensure_started(self):
+        """确保API管理器已启动（双重检查锁）"""
+        if self._started:
+            return
+        with self._start_lock:
+            if not self._started:
+                self.api_manager.start()
+                self._started = True
     
     def get_positions(self, inst_id: str) -> List[Dict[str, Any]]:
         """查询当前持仓"""
+        self._ensure_started()
+        
         def _get_positions():
             try:
                 if not settings.EXCHANGE_API_KEY:
@@ -181,6 +195,8 @@ class ExternalCloseClient:
             pos_side: 持仓方向，'long' 或 'short'
             amount: 平仓数量（币的数量），None表示全部平仓
         """
+        self._ensure_started()
+        
         def _close_position():
             try:
                 if not settings.EXCHANGE_API_KEY:
@@ -261,7 +277,7 @@ class ExternalCloseClient:
                     'reduceOnly': 'true'
                 }
                 
-                logger.info(f"[外部平仓] OKX API参数: {okx_params}")
+                logger.info("[外部平仓] OKX API参数: %s", okx_params)
                 
                 # 调用OKX API下单
                 result = self.api_manager.exchange.private_post_trade_order(okx_params)
@@ -269,8 +285,8 @@ class ExternalCloseClient:
                 if result and result.get('code') == '0' and result.get('data'):
                     order_data = result['data'][0]
                     logger.info(
-                        f"[外部平仓] 平仓成功: ordId={order_data.get('ordId')}, "
-                        f"平仓数量（币）={close_amount_coins:.6f}, 合约张数={order_amount:.1f}"
+                        "[外部平仓] 平仓成功: ordId=%s, 平仓数量（币）=%.6f, 合约张数=%.1f",
+                        order_data.get('ordId'), close_amount_coins, order_amount
                     )
                     return {
                         'success': True,
@@ -0,0 +1,8 @@
+"""
+测试共用常量
+"""
+from datetime import datetime, timezone
+
+
+# 测试统一使用的冻结时间
+FROZEN_NOW = datetime(2025, 1, 1, tzinfo=timezone.utc)
@@ -0,0 +1,49 @@
+"""
+测试公共fixture
+"""
+import pytest
+from types import SimpleNamespace
+from unittest.mock import Mock
+from freezegun import freeze_time
+from tests._constants import FROZEN_NOW
+
+
+@pytest.fixture(scope="session", autouse=True)
+def log_to_tmp(tmp_path_factory):
+    """应用日志写入临时目录，测试运行不修改工作区的logs/"""
+    log_file = str(tmp_path_factory.mktemp("logs") / "qwentradeai.log")
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr("app.config.Settings.LOG_FILE", property(lambda self: log_file))
+        # app模块在测试中延迟导入，此处首次导入logger即使用临时日志文件
+        from app.utils.logger import setup_logger
+        setup_logger()
+        yield
+
+
+@pytest.fixture(scope="session", autouse=True)
+def freeze():
+    """冻结当前时间，使时间相关断言可复现"""
+    # pandas的C扩展在冻结期间首次导入会因datetime被替换而崩溃，冻结前先导入
+    import pandas  # noqa: F401
+    with freeze_time(FROZEN_NOW):
+        yield
+
+
+class _Row(SimpleNamespace):
+    """单列查询结果行（任意下标都返回value）"""
+    
+    def __getitem__(self, key):
+        return self.value
+
+
+@pytest.fixture
+def db_row_factory():
+    """构造"查询返回一行一列"的模拟会话，返回 (session, row)，修改 row.value 即可切换返回值"""
+    def make(value):
+        row = _Row(value=value)
+        result = Mock()
+        result.fetchone.return_value = row
+        session = Mock()
+        session.execute.return_value = result
+        return session, row
+    return make
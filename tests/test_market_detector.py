@@ -1,197 +1,247 @@
 """
 市场检测器模块测试
 """
+import functools
+import math
 import pytest
-from unittest.mock import Mock, MagicMock, patch
-from datetime import datetime, timezone
-from app.layers.market_detector import (
-    MarketDetector, MarketDetectorConfig, MarketSignal, MarketType,
-    WeightConfig, ScoreBreakdown
+from types import SimpleNamespace
+from unittest.mock import Mock
+from tests._constants import FROZEN_NOW
+
+# 检测参数固定为配置默认值（不读取数据库中的配置）
+DETECTOR_SETTINGS = SimpleNamespace(
+    DETECTOR_BB_WIDTH_THRESHOLD=0.5,
+    DETECTOR_RSI_LONG_THRESHOLD=80.0,
+    DETECTOR_RSI_SHORT_THRESHOLD=20.0,
+    DETECTOR_RSI_DOUBLE_POSITION_LONG=50.0,
+    DETECTOR_RSI_DOUBLE_POSITION_SHORT=50.0,
+    DETECTOR_VOLUME_STD_MULTIPLIER=1.5,
+    DETECTOR_BB_CONFIRM_THRESHOLD=1.2,
+    DETECTOR_KLINE_15M_COUNT=100,
+    DETECTOR_KLINE_4H_COUNT=60,
+    DETECTOR_SIGNAL_EXPIRE_HOURS=4,
 )
-from app.database.connection import Database
+
+
+def _kline(**fields):
+    """构造一根K线（未指定的字段使用平稳行情的默认值）"""
+    kline = {
+        'time': FROZEN_NOW,
+        'open': 100.0,
+        'high': 101.0,
+        'low': 99.0,
+        'close': 100.0,
+        'volume': 100.0,
+        'bb_width': 0.02,
+    }
+    kline.update(fields)
+    return kline
+
+
+def _klines_15m(count=20, **latest):
+    """构造15m K线序列，只有最后一根使用指定字段"""
+    return [_kline() for _ in range(count - 1)] + [_kline(**latest)]
+
+
+# app模块在首次使用时才导入，xdist的worker收集本文件时不加载被测模块
+@functools.lru_cache(maxsize=1)
+def _database_spec():
+    """Database的spec属性列表（只计算一次，构造mock时不再反射整个类）"""
+    from app.database.connection import Database
+    return dir(Database)
+
+
+@functools.lru_cache(maxsize=1)
+def _shared_detector():
+    """评分测试共用的检测器实例（只构造一次）"""
+    from app.layers.market_detector import MarketDetector
+    return MarketDetector('BTC')
+
+
+@pytest.fixture(autouse=True, scope="module")
+def patch_repos(module_mocker):
+    """模块级统一patch K线仓储和检测配置"""
+    module_mocker.patch('app.layers.market_detector.settings', DETECTOR_SETTINGS)
+    return module_mocker.patch('app.layers.market_detector.KlineRepository')
 
 
 class TestMarketDetector:
     """市场检测器测试类"""
     
-    @pytest.fixture
+    @pytest.fixture(scope="module")
     def mock_db(self):
         """模拟数据库"""
-        db = Mock(spec=Database)
+        db = Mock(spec=_database_spec())
         db.get_session = Mock()
         return db
     
-    @pytest.fixture
-    def mock_config(self):
-        """模拟配置"""
-        config = Mock()
-        config.get_trading_symbols = Mock(return_value=['BTC', 'ETH'])
-        return config
-    
-    @pytest.fixture
-    def detector(self, mock_db, mock_config):
+    @pytest.fixture(scope="module")
+    def detector(self, mock_db):
         """创建市场检测器实例"""
-        detector_config = MarketDetectorConfig()
-        return MarketDetector(
-            db=mock_db,
-            config=mock_config,
-            detector_config=detector_config
-        )
+        from app.layers.market_detector import MarketDetector
+        detector = MarketDetector('BTC')
+        detector.db = mock_db
+        return detector
     
-    def test_weight_config_normalization(self):
-        """测试权重配置归一化"""
-        # 权重总和不为1.0，应该自动归一化
-        weights = WeightConfig(
-            price_action=0.4,
-            volume=0.3,
-            technical=0.2,
-            multi_timeframe=0.15,
-            market_env=0.1
-        )
-        total = weights.price_action + weights.volume + weights.technical + \
-                weights.multi_timeframe + weights.market_env
-        assert abs(total - 1.0) < 0.01, "权重应该归一化为1.0"
+    @pytest.fixture(autouse=True)
+    def reset_mocks(self, mock_db, patch_repos):
+        """每个测试结束后重置模块级mock，避免状态泄漏到下一个测试"""
+        yield
+        for mock in (mock_db, patch_repos):
+            mock.reset_mock(return_value=True, side_effect=True)
     
-    def test_score_breakdown_calculation(self):
-        """测试评分明细计算"""
-        breakdown = ScoreBreakdown(
-            base_score=80.0,
-            market_coef=1.0,
-            symbol_coef=1.0
-        )
-        assert breakdown.final_score == 80.0, "最终分数应该等于base_score × market_coef × symbol_coef"
+    @pytest.mark.fast
+    def test_filter_layer_insufficient_data(self, detector):
+        """测试K线不足时环境层返回中性"""
+        result = detector._filter_layer([], [_kline()])
+        assert result == ('NEUTRAL', False, None, None, False), "K线不足时应该返回中性且不活跃"
+    
+    @pytest.mark.slow
+    @pytest.mark.parametrize("close, expected_mode, expected_trend", [
+        (105.0, 'BULL', True),
+        (95.0, 'BEAR', False),
+        (100.0, 'NEUTRAL', None),
+    ])
+    def test_filter_layer_market_mode(self, detector, close, expected_mode, expected_trend):
+        """测试基于EMA55的市场模式判断"""
+        klines_15m = _klines_15m(close=close, ema_55=100.0)
+        klines_4h = [_kline(close=105.0, ema_21=100.0)]
         
-        breakdown.market_coef = 1.2
-        breakdown.symbol_coef = 0.9
-        assert breakdown.final_score == 80.0 * 1.2 * 0.9, "最终分数应该正确计算"
+        market_mode, _, trend_15m, trend_4h, multi_tf_aligned = detector._filter_layer(klines_15m, klines_4h)
+        assert market_mode == expected_mode, "市场模式判断错误"
+        assert trend_15m is expected_trend, "15m趋势判断错误"
+        assert trend_4h is True, "4h趋势判断错误"
+        assert multi_tf_aligned is (expected_trend is True), "多时间框架对齐判断错误"
     
-    @patch('app.layers.market_detector.KlineRepository')
-    @patch('app.layers.market_detector.FearGreedRepository')
-    def test_quick_filter(self, mock_fear_greed, mock_kline, detector):
-        """测试快速过滤"""
-        # 模拟K线数据
-        klines_15m = [
-            {
-                'time': datetime.now(timezone.utc),
-                'close': 100.0,
-                'open': 99.5,
-            }
-        ]
+    @pytest.mark.slow
+    @pytest.mark.parametrize("bb_width, expected_active", [
+        (0.02, True),
+        (0.005, False),
+    ])
+    def test_filter_layer_market_active(self, detector, bb_width, expected_active):
+        """测试基于布林带宽度的活跃度判断"""
+        klines_15m = _klines_15m(close=105.0, ema_55=100.0, bb_width=bb_width)
         
-        # 价格变化小于阈值，应该被过滤
-        result = detector._quick_filter(klines_15m)
-        # 注意：实际实现中，如果价格变化很小，应该返回False
-        assert isinstance(result, bool), "快速过滤应该返回布尔值"
+        _, market_active, _, _, _ = detector._filter_layer(klines_15m, [_kline()])
+        assert market_active is expected_active, "市场活跃度判断错误"
     
-    @patch('app.layers.market_detector.KlineRepository')
-    @patch('app.layers.market_detector.FearGreedRepository')
-    def test_detect_market_type(self, mock_fear_greed, mock_kline, detector):
-        """测试市场类型检测"""
-        # 模拟K线数据
-        klines_15m = [
-            {
-                'time': datetime.now(timezone.utc),
-                'adx_14': 30.0,  # 趋势市
-                'atr_14': 1.0,
-                'bb_width': 0.05,
-            }
-        ]
-        klines_4h = []
+    @pytest.mark.slow
+    @pytest.mark.parametrize("market_mode, hist_prev, hist_latest, expected", [
+        ('BULL', -0.1, 0.2, True),
+        ('BULL', 0.1, 0.2, True),
+        ('BULL', 0.3, 0.2, False),
+        ('BEAR', 0.1, -0.2, True),
+        ('BEAR', -0.1, -0.2, True),
+        ('BEAR', -0.3, -0.2, False),
+    ])
+    def test_check_momentum_turn(self, detector, market_mode, hist_prev, hist_latest, expected):
+        """测试MACD动量转折"""
+        klines_15m = [_kline(histogram=hist_prev), _kline(histogram=hist_latest)]
         
-        # 模拟恐惧贪婪指数
-        mock_fear_greed_repo = Mock()
-        mock_fear_greed_repo.get_latest_value.return_value = 50  # 中性
+        triggered, histogram = detector._check_momentum_turn(klines_15m, market_mode)
+        assert triggered is expected, "MACD动量转折判断错误"
+        assert histogram == hist_latest, "应该返回最新的MACD柱状图值"
+    
+    @pytest.mark.slow
+    @pytest.mark.parametrize("market_mode, rsi, expected, expected_multiplier", [
+        ('BULL', 40.0, True, 2.0),
+        ('BULL', 60.0, True, 1.0),
+        ('BULL', 85.0, False, 1.0),
+        ('BEAR', 60.0, True, 2.0),
+        ('BEAR', 30.0, True, 1.0),
+        ('BEAR', 15.0, False, 1.0),
+    ])
+    def test_check_rsi_extreme(self, detector, market_mode, rsi, expected, expected_multiplier):
+        """测试RSI极值和仓位倍数"""
+        triggered, rsi_value, multiplier = detector._check_rsi_extreme([_kline(rsi_7=rsi)], market_mode)
+        assert triggered is expected, "RSI极值判断错误"
+        assert rsi_value == rsi, "应该返回RSI值"
+        assert multiplier == expected_multiplier, "仓位倍数错误"
+    
+    @pytest.mark.slow
+    def test_check_volume_surge(self, detector):
+        """测试成交量异常"""
+        triggered, volume_ratio = detector._check_volume_surge(_klines_15m(volume=1000.0))
+        assert triggered, "成交量放大10倍应该触发"
+        assert math.isclose(volume_ratio, 1000.0 / 145.0), "成交量比率应该为当前/平均"
         
-        with patch('app.layers.market_detector.FearGreedRepository', return_value=mock_fear_greed_repo):
-            market_type = detector._detect_market_type(klines_15m, klines_4h)
-            assert market_type in [MarketType.TRENDING, MarketType.RANGING, 
-                                  MarketType.BREAKOUT, MarketType.EXTREME], \
-                "市场类型应该是枚举值之一"
+        triggered, volume_ratio = detector._check_volume_surge(_klines_15m())
+        assert not triggered, "成交量平稳时不应该触发"
+        assert math.isclose(volume_ratio, 1.0), "成交量平稳时比率应该为1"
     
-    def test_get_dynamic_weights(self, detector):
-        """测试动态权重计算"""
-        # 测试不同市场类型的权重
-        for market_type in MarketType:
-            weights = detector._get_dynamic_weights(market_type, 'BTC')
-            assert isinstance(weights, WeightConfig), "应该返回WeightConfig对象"
-            total = weights.price_action + weights.volume + weights.technical + \
-                    weights.multi_timeframe + weights.market_env
-            assert abs(total - 1.0) < 0.01, "权重总和应该为1.0"
+    @pytest.mark.slow
+    def test_get_klines(self, detector, mock_db, patch_repos):
+        """测试获取K线后关闭会话"""
+        session = Mock()
+        mock_db.get_session.return_value = session
+        klines = _klines_15m()
+        patch_repos.get_klines_with_indicators.return_value = klines
+        
+        assert detector._get_klines('15m', 20) == klines, "应该返回仓储查询到的K线"
+        patch_repos.get_klines_with_indicators.assert_called_once_with(session, '15m', 'BTC', limit=20)
+        session.close.assert_called_once()
     
-    @patch('app.layers.market_detector.KlineRepository')
-    @patch('app.layers.market_detector.FearGreedRepository')
-    @patch('app.layers.market_detector.MarketSignalRepository')
-    def test_detect_no_signal(self, mock_signal_repo, mock_fear_greed, mock_kline, detector):
+    @pytest.mark.slow
+    def test_detect_no_signal(self, detector, mock_db, patch_repos):
         """测试无信号情况"""
         # 模拟K线数据不足
-        mock_kline_repo = Mock()
-        mock_kline_repo.get_klines_with_indicators.return_value = []
+        patch_repos.get_klines_with_indicators.return_value = []
+        
+        result = detector.detect()
+        assert result is None, "数据不足时应该返回None"
+    
+    @pytest.mark.slow
+    def test_detect_signal(self, detector, mock_db, patch_repos, db_row_factory):
+        """测试生成做多信号"""
+        # 多头、活跃、RSI和成交量触发、成交量和布林带确认
+        klines = {
+            '15m': _klines_15m(close=110.0, ema_55=100.0, bb_width=0.04, rsi_7=40.0, volume=1000.0),
+            '4h': [_kline(close=110.0, ema_21=100.0)],
+        }
+        patch_repos.get_klines_with_indicators.side_effect = (
+            lambda session, timeframe, symbol, limit: klines[timeframe]
+        )
+        session, _ = db_row_factory(7)
+        mock_db.get_session.return_value = session
         
-        with patch('app.layers.market_detector.KlineRepository', return_value=mock_kline_repo):
-            result = detector.detect('BTC')
-            assert result is None, "数据不足时应该返回None"
+        result = detector.detect()
+        assert result is not None, "满足条件时应该生成信号"
+        assert result['signal_type'] == 'LONG', "多头模式应该生成做多信号"
+        assert result['signal_id'] == 7 and result['snapshot_id'] == 7, "应该返回保存的信号和快照ID"
+        assert result['trigger_factors'] == ['rsi_extreme', 'volume_surge'], "触发维度错误"
+        assert result['signal_strength'] == 'VERY_STRONG', "信号强度错误"
+        assert result['confidence_score'] == 70.0, "置信度错误"
 
 
+@pytest.mark.fast
 class TestMarketSignalScoring:
     """市场信号评分测试"""
     
-    @pytest.fixture
-    def mock_klines(self):
-        """模拟K线数据"""
-        return [
-            {
-                'time': datetime.now(timezone.utc),
-                'open': 100.0,
-                'high': 105.0,
-                'low': 99.0,
-                'close': 104.0,
-                'volume': 1000.0,
-                'rsi_7': 60.0,
-                'macd_line': 0.5,
-                'signal_line': 0.3,
-                'histogram': 0.2,
-                'ema_9': 102.0,
-                'ema_21': 101.0,
-                'bb_upper': 106.0,
-                'bb_middle': 102.0,
-                'bb_lower': 98.0,
-                'atr_14': 2.0,
-            }
-        ]
-    
-    @pytest.fixture
-    def mock_weights(self):
-        """模拟权重配置"""
-        return WeightConfig()
-    
-    def test_calc_volume_score(self, mock_klines, mock_weights):
-        """测试成交量评分"""
-        detector = MarketDetector(
-            db=Mock(),
-            config=Mock(),
-            detector_config=MarketDetectorConfig()
-        )
+    @pytest.mark.parametrize("trigger_count, aligned, volume_confirm, bb_confirm, expected", [
+        (1, False, False, False, 'WEAK'),
+        (1, True, True, False, 'MODERATE'),
+        (2, False, True, False, 'STRONG'),
+        (2, True, True, True, 'VERY_STRONG'),
+    ])
+    def test_calculate_signal_strength(self, trigger_count, aligned, volume_confirm, bb_confirm, expected):
+        """测试信号强度分级"""
+        detector = _shared_detector()
         
-        score = detector._calc_volume_score(mock_klines, 1.5)  # 1.5倍放大
-        assert 0 <= score <= 100, "成交量分数应该在0-100之间"
+        strength = detector._calculate_signal_strength(trigger_count, aligned, volume_confirm, bb_confirm)
+        assert strength == expected, "信号强度分级错误"
     
-    def test_calc_rsi_score(self):
-        """测试RSI评分"""
-        detector = MarketDetector(
-            db=Mock(),
-            config=Mock(),
-            detector_config=MarketDetectorConfig()
-        )
-        
-        # 测试超卖情况
-        score_oversold = detector._calc_rsi_score(20.0, is_oversold=True)
-        assert score_oversold > 0, "超卖时RSI分数应该大于0"
+    @pytest.mark.parametrize("trigger_count, aligned, volume_confirm, bb_confirm, expected", [
+        (1, False, False, False, 15.0),
+        (2, True, True, False, 55.0),
+        (6, True, True, True, 100.0),
+    ])
+    def test_calculate_confidence_score(self, trigger_count, aligned, volume_confirm, bb_confirm, expected):
+        """测试置信度分数（上限100）"""
+        detector = _shared_detector()
         
-        # 测试超买情况
-        score_overbought = detector._calc_rsi_score(80.0, is_overbought=True)
-        assert score_overbought > 0, "超买时RSI分数应该大于0"
+        score = detector._calculate_confidence_score(trigger_count, aligned, volume_confirm, bb_confirm)
+        assert score == expected, "置信度分数错误"
 
 
 if __name__ == '__main__':
     pytest.main([__file__, '-v'])
-
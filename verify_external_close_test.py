@@ -7,17 +7,19 @@
 第二步：order_history 表验证
 第三步：数据一致性验证
 """
+import io
 import os
 import sys
-from typing import Dict, List, Any, Optional, Tuple
+from collections import defaultdict
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
+from datetime import datetime
+from typing import Callable, Dict, List, Any, NamedTuple, Optional, Set, Tuple
+import numpy as np
 from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker, Session
-from dotenv import load_dotenv
-from decimal import Decimal
-import importlib.util
-
-# 加载环境变量
-load_dotenv()
+from sqlalchemy.engine import Connection
+from verify_numeric_kernels import batch_close
 
 # 合约乘数配置
 CONTRACT_SIZE = {
@@ -25,15 +27,125 @@ CONTRACT_SIZE = {
     'BTC': 1.0
 }
 
+class TRRow(NamedTuple):
+    """trading_relations 记录"""
+    id: int
+    signal_id: int
+    cl_ord_id: Optional[str]
+    ord_id: Optional[str]
+    position_history_id: Optional[int]
+    operation_type: str
+    amount: Optional[float]
+    price: Optional[float]
+    created_at: datetime
+
+
+class OrderRow(NamedTuple):
+    """order_history 记录"""
+    ord_id: str
+    cl_ord_id: Optional[str]
+    symbol: str
+    inst_id: str
+    sz: float  # 合约数量
+    side: str
+    pos_side: Optional[str]
+    state: str
+    acc_fill_sz: float
+    fill_px: Optional[float]
+    fill_time: Optional[datetime]
+    c_time: Optional[datetime]
+
+
+# 测试步骤类型 -> trading_relations.operation_type
+OPERATION_TYPE_MAP = {
+    'API开仓': 'open',
+    'API加仓': 'add',
+    'API减仓': 'reduce',
+    'API全部平仓': 'close',
+    '外部部分平仓': 'reduce',
+    '外部全部平仓': 'close'
+}
+
+# trading_relations 操作类型
+OPERATION_TYPES = ('open', 'add', 'reduce', 'close')
+CLOSE_OPERATION_TYPES = frozenset({'reduce', 'close'})
+
+# 步骤类型分类（API操作 / 外部平仓 / 产生记录的全部操作 / 以平仓结束）
+API_STEP_TYPES = frozenset({'API开仓', 'API加仓', 'API减仓', 'API全部平仓'})
+EXTERNAL_STEP_TYPES = frozenset({'外部部分平仓', '外部全部平仓'})
+ALL_OP_STEP_TYPES = API_STEP_TYPES | EXTERNAL_STEP_TYPES
+CLOSE_STEP_TYPES = EXTERNAL_STEP_TYPES | {'API全部平仓'}
+
+
+# 热点查询语句（模块级构造一次，复用 SQLAlchemy 编译缓存）
+TR_BY_SIGNAL_IDS_SQL = text("""
+    SELECT 
+        id, signal_id, cl_ord_id, ord_id, position_history_id,
+        operation_type, amount, price, created_at
+    FROM trading_relations
+    WHERE signal_id = ANY(:signal_ids)
+    ORDER BY signal_id, created_at ASC
+""")
+
+OPERATION_SUMS_SQL = text("""
+    SELECT signal_id, operation_type, SUM(amount)
+    FROM trading_relations
+    WHERE signal_id = ANY(:signal_ids)
+    GROUP BY signal_id, operation_type
+""")
+
+# 按 cl_ord_id 批量汇总订单数与合约数量之和
+ORDER_STATS_BULK_SQL = text("""
+    SELECT cl_ord_id, count(*), COALESCE(SUM(sz), 0)
+    FROM order_history
+    WHERE cl_ord_id = ANY(:cl_ord_ids)
+    GROUP BY cl_ord_id
+""")
+
+ORDER_BY_CL_ORD_IDS_SQL = text("""
+    SELECT 
+        ord_id, cl_ord_id, symbol, inst_id, sz, side, pos_side,
+        state, acc_fill_sz, fill_px, fill_time, c_time
+    FROM order_history
+    WHERE cl_ord_id = ANY(:cl_ord_ids)
+    ORDER BY cl_ord_id, c_time ASC
+""")
+
+ORDER_BY_SIGNAL_IDS_SQL = text("""
+    SELECT 
+        oh.ord_id, oh.cl_ord_id, oh.symbol, oh.inst_id, oh.sz, oh.side, oh.pos_side,
+        oh.state, oh.acc_fill_sz, oh.fill_px, oh.fill_time, oh.c_time
+    FROM order_history oh
+    JOIN trading_relations tr ON oh.ord_id = tr.ord_id
+    WHERE tr.signal_id = ANY(:signal_ids)
+""")
 
+EXISTING_ORD_IDS_SQL = text("""
+    SELECT ord_id
+    FROM order_history
+    WHERE ord_id = ANY(:ord_ids)
+""")
+
+# 单次 ANY(:ord_ids) 查询的最大ord_id数
+ORD_ID_CHUNK_SIZE = 1000
+
+
+@lru_cache(maxsize=256)
+def get_contract_size(symbol: str) -> float:
+    """获取合约乘数（按交易对缓存）"""
+    return CONTRACT_SIZE.get(symbol.upper(), 0.1)
+
+
+@lru_cache(maxsize=1)
 def get_test_scenarios():
-    """从 external_close_test.py 读取测试场景配置"""
+    """从 external_close_test.py 读取测试场景配置（每个进程只加载一次）"""
     script_path = os.path.join(os.path.dirname(__file__), 'external_close_test.py')
     
     if not os.path.exists(script_path):
         raise FileNotFoundError(f"未找到测试脚本: {script_path}")
     
     # 动态导入模块
+    import importlib.util
     spec = importlib.util.spec_from_file_location("external_close_test", script_path)
     module = importlib.util.module_from_spec(spec)
     spec.loader.exec_module(module)
@@ -63,6 +175,34 @@ def get_test_scenarios():
     return scenarios_dict
 
 
+def _verify_no_external_close(last_tr_record: TRRow, result: Dict[str, Any], out: io.StringIO):
+    """场景没有外部平仓步骤：无需校验"""
+
+
+def _verify_last_external_full_close(last_tr_record: TRRow, result: Dict[str, Any], out: io.StringIO):
+    """最后一个外部平仓步骤为全部平仓：最后一条记录必须为close"""
+    if last_tr_record.operation_type == 'close':
+        print("✓ 最后一条外部全部平仓正确识别为close", file=out)
+    else:
+        result['passed'] = False
+        error_msg = f"最后一条外部全部平仓应该为close，实际为{last_tr_record.operation_type}"
+        result['errors'].append(error_msg)
+        print(f"✗ {error_msg}", file=out)
+
+
+def _verify_last_external_partial_close(last_tr_record: TRRow, result: Dict[str, Any], out: io.StringIO):
+    """最后一个外部平仓步骤为部分平仓：只输出operation_type"""
+    print(f"✓ 最后一条是外部部分平仓，operation_type={last_tr_record.operation_type}", file=out)
+
+
+# 第三步第5项（最后一条外部平仓）校验函数，按场景最后一个外部平仓步骤类型选择
+LAST_EXTERNAL_VERIFIERS: Dict[Optional[str], Callable[[TRRow, Dict[str, Any], io.StringIO], None]] = {
+    None: _verify_no_external_close,
+    '外部全部平仓': _verify_last_external_full_close,
+    '外部部分平仓': _verify_last_external_partial_close,
+}
+
+
 class ExternalCloseTestVerifier:
     """外部平仓测试数据验证器"""
     
@@ -74,27 +214,47 @@ class ExternalCloseTestVerifier:
         
         print(f"正在连接数据库: {self.database_url.split('@')[1] if '@' in self.database_url else '***'}")
         
+        # 只读验证：复用一个自动提交连接，避免每条查询的隐式事务和归还时的ROLLBACK
         self.engine = create_engine(
             self.database_url,
             pool_pre_ping=True,
-            pool_recycle=3600
+            pool_recycle=3600,
+            isolation_level="AUTOCOMMIT"
         )
-        self.SessionLocal = sessionmaker(bind=self.engine)
-        self.session: Optional[Session] = None
+        self.conn: Optional[Connection] = None
         
         # 测试场景配置
         self.test_scenarios = get_test_scenarios()
+        self._sorted_signal_ids = tuple(sorted(self.test_scenarios.keys()))
+        self._scenarios_sorted = [self.test_scenarios[i] for i in self._sorted_signal_ids]
+        
+        # 预热合约乘数缓存（场景涉及的交易对）
+        for symbol in {scenario['symbol'] for scenario in self._scenarios_sorted}:
+            get_contract_size(symbol)
+        
+        # 按场景选择第三步第5项的校验函数（场景步骤在启动时已知）
+        self._scenario_verifiers: Dict[int, Callable] = {}
+        for signal_id, scenario in zip(self._sorted_signal_ids, self._scenarios_sorted):
+            last_external_type = None
+            for step in scenario['steps']:
+                if step['step_type'] in EXTERNAL_STEP_TYPES:
+                    last_external_type = step['step_type']
+            self._scenario_verifiers[signal_id] = LAST_EXTERNAL_VERIFIERS[last_external_type]
         
         # 验证结果
         self.step1_results = {}  # trading_relations 验证结果
         self.step2_results = {}   # order_history 验证结果
         self.step3_results = {}   # 数据一致性验证结果
+        
+        # 跨步骤复用的中间结果
+        self.tr_records_cache: Dict[int, List[TRRow]] = {}  # signal_id -> trading_relations 记录
+        self.scenario_sums: Dict[int, Dict[str, float]] = {}  # signal_id -> 各操作类型数量汇总
     
     def connect(self):
         """建立数据库连接"""
         try:
-            self.session = self.SessionLocal()
-            self.session.execute(text("SELECT 1"))
+            self.conn = self.engine.connect()
+            self.conn.execute(text("SELECT 1"))
             print("✓ 数据库连接成功\n")
             return True
         except Exception as e:
@@ -103,8 +263,8 @@ class ExternalCloseTestVerifier:
     
     def close(self):
         """关闭数据库连接"""
-        if self.session:
-            self.session.close()
+        if self.conn:
+            self.conn.close()
         self.engine.dispose()
     
     def float_compare(self, a: float, b: float, tolerance: float = 0.01) -> bool:
@@ -113,95 +273,121 @@ class ExternalCloseTestVerifier:
             return False
         return abs(a - b) <= tolerance
     
-    def get_contract_size(self, symbol: str) -> float:
-        """获取合约乘数"""
-        return CONTRACT_SIZE.get(symbol.upper(), 0.1)
-    
-    def get_trading_relations_by_signal_id(self, signal_id: int) -> List[Dict[str, Any]]:
-        """根据signal_id获取trading_relations记录"""
-        sql = text("""
-            SELECT 
-                id, signal_id, cl_ord_id, ord_id, position_history_id,
-                operation_type, amount, price, created_at
-            FROM trading_relations
-            WHERE signal_id = :signal_id
-            ORDER BY created_at ASC
-        """)
-        result = self.session.execute(sql, {'signal_id': signal_id}).fetchall()
-        
-        records = []
-        for row in result:
-            records.append({
-                'id': row[0],
-                'signal_id': row[1],
-                'cl_ord_id': row[2],
-                'ord_id': row[3],
-                'position_history_id': row[4],
-                'operation_type': row[5],
-                'amount': float(row[6]) if row[6] else None,
-                'price': float(row[7]) if row[7] else None,
-                'created_at': row[8]
-            })
-        return records
-    
-    def get_order_history_by_cl_ord_id(self, cl_ord_id: str) -> List[Dict[str, Any]]:
-        """根据cl_ord_id获取order_history记录"""
-        sql = text("""
-            SELECT 
-                ord_id, cl_ord_id, symbol, inst_id, sz, side, pos_side,
-                state, acc_fill_sz, fill_px, fill_time, c_time
-            FROM order_history
-            WHERE cl_ord_id = :cl_ord_id
-            ORDER BY c_time ASC
-        """)
-        result = self.session.execute(sql, {'cl_ord_id': cl_ord_id}).fetchall()
-        
-        orders = []
-        for row in result:
-            orders.append({
-                'ord_id': row[0],
-                'cl_ord_id': row[1],
-                'symbol': row[2],
-                'inst_id': row[3],
-                'sz': float(row[4]) if row[4] else 0.0,  # 合约数量
-                'side': row[5],
-                'pos_side': row[6],
-                'state': row[7],
-                'acc_fill_sz': float(row[8]) if row[8] else 0.0,
-                'fill_px': float(row[9]) if row[9] else None,
-                'fill_time': row[10],
-                'c_time': row[11]
-            })
-        return orders
-    
-    def get_order_history_by_ord_id(self, ord_id: str) -> Optional[Dict[str, Any]]:
-        """根据ord_id获取order_history记录"""
-        sql = text("""
-            SELECT 
-                ord_id, cl_ord_id, symbol, inst_id, sz, side, pos_side,
-                state, acc_fill_sz, fill_px, fill_time, c_time
-            FROM order_history
-            WHERE ord_id = :ord_id
-            LIMIT 1
-        """)
-        result = self.session.execute(sql, {'ord_id': ord_id}).fetchone()
-        
-        if result:
-            return {
-                'ord_id': result[0],
-                'cl_ord_id': result[1],
-                'symbol': result[2],
-                'inst_id': result[3],
-                'sz': float(result[4]) if result[4] else 0.0,
-                'side': result[5],
-                'pos_side': result[6],
-                'state': result[7],
-                'acc_fill_sz': float(result[8]) if result[8] else 0.0,
-                'fill_px': float(result[9]) if result[9] else None,
-                'fill_time': result[10],
-                'c_time': result[11]
-            }
-        return None
+    @staticmethod
+    def _tr_row_to_record(row) -> TRRow:
+        """trading_relations 查询行转记录"""
+        return TRRow(
+            row[0], row[1], row[2], row[3], row[4], row[5],
+            float(row[6]) if row[6] else None,
+            float(row[7]) if row[7] else None,
+            row[8]
+        )
+    
+    @staticmethod
+    def _order_row_to_record(row) -> OrderRow:
+        """order_history 查询行转记录"""
+        return OrderRow(
+            row[0], row[1], row[2], row[3],
+            float(row[4]) if row[4] else 0.0,  # 合约数量
+            row[5], row[6], row[7],
+            float(row[8]) if row[8] else 0.0,
+            float(row[9]) if row[9] else None,
+            row[10], row[11]
+        )
+    
+    def _ordered_results(self, results: Dict[int, Dict[str, Any]]):
+        """按预先排好的 signal_id 顺序遍历结果（不依赖写入顺序，无需每次排序）"""
+        return ((signal_id, results[signal_id]) for signal_id in self._sorted_signal_ids if signal_id in results)
+    
+    @staticmethod
+    def _flush_log(out: io.StringIO):
+        """一次性写出缓冲的场景输出"""
+        sys.stdout.write(out.getvalue())
+    
+    @staticmethod
+    def _created_at_us(records: List[TRRow]) -> np.ndarray:
+        """created_at 转为 epoch 微秒数组（带时区的时间无法直接转 datetime64）"""
+        return np.fromiter(
+            (round(r.created_at.timestamp() * 1_000_000) for r in records),
+            dtype=np.int64, count=len(records)
+        )
+    
+    def get_cached_trading_relations(self, signal_ids: List[int]) -> Dict[int, List[TRRow]]:
+        """获取trading_relations记录（未缓存的signal_id一次批量查询后缓存，供三个步骤复用）"""
+        missing = [signal_id for signal_id in signal_ids if signal_id not in self.tr_records_cache]
+        if missing:
+            self.tr_records_cache.update(self.get_trading_relations_bulk(missing))
+        return self.tr_records_cache
+    
+    def get_scenario_sums(self, signal_ids: List[int]) -> Dict[int, Dict[str, float]]:
+        """获取各场景操作类型的数量汇总（优先复用第一步结果，缺失的由数据库聚合）"""
+        missing = [signal_id for signal_id in signal_ids if signal_id not in self.scenario_sums]
+        if missing:
+            self.scenario_sums.update(self.get_operation_sums_bulk(missing))
+        return self.scenario_sums
+    
+    def get_operation_sums_bulk(self, signal_ids: List[int]) -> Dict[int, Dict[str, float]]:
+        """数据库端按 signal_id、operation_type 聚合数量（一次查询）"""
+        signal_ids = list(signal_ids)
+        result = self.conn.execute(OPERATION_SUMS_SQL, {'signal_ids': signal_ids}).fetchall()
+        
+        sums_by_signal = {signal_id: dict.fromkeys(OPERATION_TYPES, 0.0) for signal_id in signal_ids}
+        for signal_id, operation_type, total in result:
+            if operation_type in OPERATION_TYPES:
+                sums_by_signal[signal_id][operation_type] = float(total) if total else 0.0
+        return sums_by_signal
+    
+    def get_trading_relations_bulk(self, signal_ids: List[int]) -> Dict[int, List[TRRow]]:
+        """批量获取多个signal_id的trading_relations记录（一次查询，按signal_id分组）"""
+        signal_ids = list(signal_ids)
+        result = self.conn.execute(TR_BY_SIGNAL_IDS_SQL, {'signal_ids': signal_ids}).fetchall()
+        
+        records_by_signal = {signal_id: [] for signal_id in signal_ids}
+        for signal_id, rows in groupby(result, key=itemgetter(1)):
+            records_by_signal[signal_id] = [self._tr_row_to_record(row) for row in rows]
+        return records_by_signal
+    
+    def get_order_stats_bulk(self, cl_ord_ids: List[str]) -> Dict[str, Tuple[int, float]]:
+        """批量汇总各cl_ord_id的订单数和合约数量之和（一次查询），返回 {cl_ord_id: (订单数, sz之和)}"""
+        if not cl_ord_ids:
+            return {}
+        result = self.conn.execute(ORDER_STATS_BULK_SQL, {'cl_ord_ids': list(cl_ord_ids)}).fetchall()
+        return {row[0]: (row[1], float(row[2])) for row in result}
+    
+    def get_order_history_by_cl_ord_ids(self, cl_ord_ids: List[str]) -> Dict[str, List[OrderRow]]:
+        """批量获取多个cl_ord_id的order_history记录（一次查询，按cl_ord_id分组）"""
+        cl_ord_ids = list(cl_ord_ids)
+        result = self.conn.execute(ORDER_BY_CL_ORD_IDS_SQL, {'cl_ord_ids': cl_ord_ids}).fetchall()
+        
+        orders_by_cl_ord_id = {cl_ord_id: [] for cl_ord_id in cl_ord_ids}
+        for cl_ord_id, rows in groupby(result, key=itemgetter(1)):
+            orders_by_cl_ord_id[cl_ord_id] = [self._order_row_to_record(row) for row in rows]
+        return orders_by_cl_ord_id
+    
+    def get_order_history_by_signal_ids(self, signal_ids: List[int]) -> Dict[str, OrderRow]:
+        """通过 trading_relations 关联一次查询多个signal_id的order_history记录（按ord_id索引）"""
+        result = self.conn.execute(ORDER_BY_SIGNAL_IDS_SQL, {'signal_ids': list(signal_ids)}).fetchall()
+        return {row[0]: self._order_row_to_record(row) for row in result}
+    
+    def _run_scenarios(
+        self,
+        verify_fn: Callable[[int, Dict, io.StringIO], Dict[str, Any]],
+        results: Dict[int, Dict[str, Any]]
+    ):
+        """按 signal_id 顺序验证各场景并收集结果（各场景输出缓冲后一次写出）"""
+        for signal_id, scenario in zip(self._sorted_signal_ids, self._scenarios_sorted):
+            out = io.StringIO()
+            results[signal_id] = verify_fn(signal_id, scenario, out)
+            self._flush_log(out)
+    
+    def get_existing_ord_ids(self, ord_ids: List[str]) -> Set[str]:
+        """返回order_history中存在的ord_id集合（按ORD_ID_CHUNK_SIZE分批查询）"""
+        ord_ids = list(dict.fromkeys(ord_ids))
+        existing = set()
+        for start in range(0, len(ord_ids), ORD_ID_CHUNK_SIZE):
+            chunk = ord_ids[start:start + ORD_ID_CHUNK_SIZE]
+            existing.update(self.conn.execute(EXISTING_ORD_IDS_SQL, {'ord_ids': chunk}).scalars())
+        return existing
     
     def step1_verify_trading_relations(self):
         """第一步：trading_relations 表验证"""
@@ -209,29 +395,37 @@ class ExternalCloseTestVerifier:
         print("第一步：trading_relations 表验证")
         print("="*60)
         
-        for signal_id in sorted(self.test_scenarios.keys()):
-            scenario = self.test_scenarios[signal_id]
-            result = self._verify_trading_relations_scenario(signal_id, scenario)
-            self.step1_results[signal_id] = result
+        # 一次查询获取所有场景的记录（缓存供后续步骤复用）
+        records_by_signal = self.get_cached_trading_relations(self._sorted_signal_ids)
+        
+        self._run_scenarios(
+            lambda signal_id, scenario, out: self._verify_trading_relations_scenario(
+                signal_id, scenario, records_by_signal[signal_id], out
+            ),
+            self.step1_results
+        )
         
         # 汇总结果
         self._print_step1_summary()
     
-    def _verify_trading_relations_scenario(self, signal_id: int, scenario: Dict) -> Dict[str, Any]:
-        """验证单个场景的 trading_relations 数据"""
+    def _verify_trading_relations_scenario(
+        self,
+        signal_id: int,
+        scenario: Dict,
+        actual_records: List[TRRow],
+        out: io.StringIO
+    ) -> Dict[str, Any]:
+        """验证单个场景的 trading_relations 数据（输出写入 out 缓冲）"""
         scenario_name = scenario['name']
         scenario_num = scenario['scenario_num']
         symbol = scenario['symbol']
         side = scenario['side']
         steps = scenario['steps']
         
-        print(f"\n{'='*60}")
-        print(f"验证场景{scenario_num}: {scenario_name} (signal_id={signal_id})")
-        print(f"交易对: {symbol}, 方向: {side}")
-        print(f"{'='*60}")
-        
-        # 获取实际记录
-        actual_records = self.get_trading_relations_by_signal_id(signal_id)
+        print(f"\n{'='*60}", file=out)
+        print(f"验证场景{scenario_num}: {scenario_name} (signal_id={signal_id})", file=out)
+        print(f"交易对: {symbol}, 方向: {side}", file=out)
+        print(f"{'='*60}", file=out)
         
         result = {
             'signal_id': signal_id,
@@ -247,177 +441,178 @@ class ExternalCloseTestVerifier:
         }
         
         # 1. 检查记录数量
-        expected_count = len([s for s in steps if s['step_type'] in ['API开仓', 'API加仓', 'API减仓', 'API全部平仓', '外部部分平仓', '外部全部平仓']])
+        record_steps = [s for s in steps if s['step_type'] in ALL_OP_STEP_TYPES]
+        expected_count = len(record_steps)
         if len(actual_records) != expected_count:
             result['passed'] = False
             error_msg = f"记录数量不匹配: 期望{expected_count}条，实际{len(actual_records)}条"
             result['errors'].append(error_msg)
-            print(f"✗ {error_msg}")
+            print(f"✗ {error_msg}", file=out)
         else:
-            print(f"✓ 记录数量正确: {len(actual_records)}条")
+            print(f"✓ 记录数量正确: {len(actual_records)}条", file=out)
         
         if len(actual_records) == 0:
             result['passed'] = False
             result['errors'].append("未找到任何记录")
             return result
         
+        # 单次遍历收集 cl_ord_id、signal_id 和各操作类型数量
+        cl_ord_ids = set()
+        signal_ids = set()
+        op_sums = defaultdict(float)
+        for r in actual_records:
+            if r.cl_ord_id:
+                cl_ord_ids.add(r.cl_ord_id)
+            signal_ids.add(r.signal_id)
+            op_sums[r.operation_type] += r.amount or 0.0
+        sums = {op: op_sums[op] for op in OPERATION_TYPES}
+        self.scenario_sums[signal_id] = sums
+        
         # 2. 检查 cl_ord_id 一致性
-        cl_ord_ids = set(r['cl_ord_id'] for r in actual_records if r['cl_ord_id'])
         if len(cl_ord_ids) > 1:
             result['passed'] = False
             error_msg = f"cl_ord_id不一致: {cl_ord_ids}"
             result['errors'].append(error_msg)
-            print(f"✗ {error_msg}")
+            print(f"✗ {error_msg}", file=out)
         elif len(cl_ord_ids) == 1:
-            print(f"✓ cl_ord_id一致: {list(cl_ord_ids)[0]}")
+            print(f"✓ cl_ord_id一致: {list(cl_ord_ids)[0]}", file=out)
         else:
             result['warnings'].append("所有记录的cl_ord_id为空")
-            print(f"⚠ 所有记录的cl_ord_id为空")
+            print(f"⚠ 所有记录的cl_ord_id为空", file=out)
         
         # 3. 检查 signal_id 一致性
-        signal_ids = set(r['signal_id'] for r in actual_records)
         if len(signal_ids) > 1 or (signal_ids and list(signal_ids)[0] != signal_id):
             result['passed'] = False
             error_msg = f"signal_id不一致: {signal_ids}"
             result['errors'].append(error_msg)
-            print(f"✗ {error_msg}")
+            print(f"✗ {error_msg}", file=out)
         else:
-            print(f"✓ signal_id一致: {signal_id}")
+            print(f"✓ signal_id一致: {signal_id}", file=out)
         
         # 4. 检查操作类型和数量
-        api_steps = [s for s in steps if s['step_type'] in ['API开仓', 'API加仓', 'API减仓', 'API全部平仓']]
-        external_steps = [s for s in steps if s['step_type'] in ['外部部分平仓', '外部全部平仓']]
-        
-        # 映射操作类型
-        operation_type_map = {
-            'API开仓': 'open',
-            'API加仓': 'add',
-            'API减仓': 'reduce',
-            'API全部平仓': 'close',
-            '外部部分平仓': 'reduce',
-            '外部全部平仓': 'close'
-        }
+        # 按记录顺序对齐期望数量，批量计算amount是否在误差范围内（空值记为nan）
+        aligned = min(len(record_steps), len(actual_records))
+        expected_amounts = np.array(
+            [s['amount'] if s['amount'] is not None else np.nan for s in record_steps[:aligned]],
+            dtype=np.float64
+        )
+        actual_amounts = np.array(
+            [r.amount if r.amount is not None else np.nan for r in actual_records[:aligned]],
+            dtype=np.float64
+        )
+        tolerances = np.where(expected_amounts > 0, np.abs(expected_amounts * 0.01), 0.01)
+        amount_matches = np.isclose(actual_amounts, expected_amounts, rtol=0, atol=tolerances)
         
         # 验证API操作的记录
-        api_record_idx = 0
-        for i, step in enumerate(steps):
+        for i, step in enumerate(record_steps):
             step_type = step['step_type']
-            if step_type not in operation_type_map:
-                continue
-            
-            expected_op_type = operation_type_map[step_type]
+            expected_op_type = OPERATION_TYPE_MAP[step_type]
             expected_amount = step['amount']
             
-            if api_record_idx >= len(actual_records):
+            if i >= len(actual_records):
                 result['passed'] = False
-                error_msg = f"缺少第{api_record_idx+1}条记录: 期望{expected_op_type}, amount={expected_amount}"
+                error_msg = f"缺少第{i+1}条记录: 期望{expected_op_type}, amount={expected_amount}"
                 result['errors'].append(error_msg)
-                print(f"✗ {error_msg}")
+                print(f"✗ {error_msg}", file=out)
                 continue
             
-            actual_record = actual_records[api_record_idx]
+            actual_record = actual_records[i]
             
             # 检查 operation_type
-            if actual_record['operation_type'] != expected_op_type:
+            if actual_record.operation_type != expected_op_type:
                 result['passed'] = False
-                error_msg = f"第{api_record_idx+1}条记录operation_type错误: 期望{expected_op_type}, 实际{actual_record['operation_type']}"
+                error_msg = f"第{i+1}条记录operation_type错误: 期望{expected_op_type}, 实际{actual_record.operation_type}"
                 result['errors'].append(error_msg)
-                print(f"✗ {error_msg}")
+                print(f"✗ {error_msg}", file=out)
             else:
-                print(f"✓ 第{api_record_idx+1}条记录operation_type正确: {expected_op_type}")
+                print(f"✓ 第{i+1}条记录operation_type正确: {expected_op_type}", file=out)
             
-            # 检查 amount（对于外部平仓，amount可能不准确，只检查API操作）
-            if step_type in ['API开仓', 'API加仓', 'API减仓', 'API全部平仓']:
-                if actual_record['amount'] is None:
-                    if expected_amount is not None and expected_amount > 0:
-                        result['passed'] = False
-                        error_msg = f"第{api_record_idx+1}条记录amount为空，期望{expected_amount}"
-                        result['errors'].append(error_msg)
-                        print(f"✗ {error_msg}")
-                elif expected_amount is not None:
-                    tolerance = abs(expected_amount * 0.01) if expected_amount > 0 else 0.01
-                    if not self.float_compare(actual_record['amount'], expected_amount, tolerance):
-                        result['passed'] = False
-                        error_msg = f"第{api_record_idx+1}条记录amount错误: 期望{expected_amount}, 实际{actual_record['amount']}"
-                        result['errors'].append(error_msg)
-                        print(f"✗ {error_msg}")
-                    else:
-                        print(f"✓ 第{api_record_idx+1}条记录amount正确: {actual_record['amount']} (期望{expected_amount})")
+            # 外部平仓的amount可能不准确、可能没有ord_id，只检查API操作
+            if step_type not in API_STEP_TYPES:
+                continue
             
-            # 检查 ord_id（API操作必须有ord_id，外部平仓可能没有）
-            if step_type in ['API开仓', 'API加仓', 'API减仓', 'API全部平仓']:
-                if not actual_record['ord_id']:
-                    result['warnings'].append(f"第{api_record_idx+1}条API操作记录没有ord_id")
-                    print(f"⚠ 第{api_record_idx+1}条API操作记录没有ord_id")
+            # 检查 amount
+            if actual_record.amount is None:
+                if expected_amount is not None and expected_amount > 0:
+                    result['passed'] = False
+                    error_msg = f"第{i+1}条记录amount为空，期望{expected_amount}"
+                    result['errors'].append(error_msg)
+                    print(f"✗ {error_msg}", file=out)
+            elif expected_amount is not None:
+                if not amount_matches[i]:
+                    result['passed'] = False
+                    error_msg = f"第{i+1}条记录amount错误: 期望{expected_amount}, 实际{actual_record.amount}"
+                    result['errors'].append(error_msg)
+                    print(f"✗ {error_msg}", file=out)
                 else:
-                    print(f"✓ 第{api_record_idx+1}条记录有ord_id: {actual_record['ord_id']}")
+                    print(f"✓ 第{i+1}条记录amount正确: {actual_record.amount} (期望{expected_amount})", file=out)
             
-            api_record_idx += 1
+            # 检查 ord_id（API操作必须有ord_id）
+            if not actual_record.ord_id:
+                result['warnings'].append(f"第{i+1}条API操作记录没有ord_id")
+                print(f"⚠ 第{i+1}条API操作记录没有ord_id", file=out)
+            else:
+                print(f"✓ 第{i+1}条记录有ord_id: {actual_record.ord_id}", file=out)
         
         # 5. 检查最后一条外部平仓是否为 close
         if len(actual_records) > 0:
             last_record = actual_records[-1]
             last_step = steps[-1] if steps else None
             
-            if last_step and last_step['step_type'] in ['外部部分平仓', '外部全部平仓', 'API全部平仓']:
-                if last_record['operation_type'] == 'close':
-                    print(f"✓ 最后一条平仓记录operation_type正确: close")
-                elif last_record['operation_type'] == 'reduce':
+            if last_step and last_step['step_type'] in CLOSE_STEP_TYPES:
+                if last_record.operation_type == 'close':
+                    print(f"✓ 最后一条平仓记录operation_type正确: close", file=out)
+                elif last_record.operation_type == 'reduce':
                     # 如果是外部全部平仓，应该是close
                     if last_step['step_type'] == '外部全部平仓':
                         result['passed'] = False
                         error_msg = "最后一条外部全部平仓记录operation_type应该是close，实际是reduce"
                         result['errors'].append(error_msg)
-                        print(f"✗ {error_msg}")
+                        print(f"✗ {error_msg}", file=out)
                     else:
-                        print(f"✓ 最后一条部分平仓记录operation_type: reduce")
+                        print(f"✓ 最后一条部分平仓记录operation_type: reduce", file=out)
         
         # 6. 检查时间戳递增
         if len(actual_records) > 1:
-            prev_time = actual_records[0]['created_at']
-            time_ok = True
-            for i in range(1, len(actual_records)):
-                curr_time = actual_records[i]['created_at']
-                if curr_time < prev_time:
-                    time_ok = False
-                    break
-                prev_time = curr_time
-            
-            if time_ok:
-                print(f"✓ 时间戳递增正确")
+            ordered = np.diff(self._created_at_us(actual_records)) >= 0
+            if ordered.all():
+                print(f"✓ 时间戳递增正确", file=out)
             else:
-                result['warnings'].append("时间戳未严格递增")
-                print(f"⚠ 时间戳未严格递增")
+                # 第一个逆序位置（diff下标i对应第i+2条记录）
+                bad_idx = int(np.argmin(ordered)) + 2
+                warning_msg = f"时间戳未严格递增: 第{bad_idx}条记录早于上一条"
+                result['warnings'].append(warning_msg)
+                print(f"⚠ {warning_msg}", file=out)
         
         # 7. 计算数量统计
-        open_amount = sum(r['amount'] or 0 for r in actual_records if r['operation_type'] == 'open')
-        add_amount = sum(r['amount'] or 0 for r in actual_records if r['operation_type'] == 'add')
-        reduce_amount = sum(r['amount'] or 0 for r in actual_records if r['operation_type'] == 'reduce')
-        close_amount = sum(r['amount'] or 0 for r in actual_records if r['operation_type'] == 'close')
+        open_amount = sums['open']
+        add_amount = sums['add']
+        reduce_amount = sums['reduce']
+        close_amount = sums['close']
         
         total_open = open_amount + add_amount
         total_close = reduce_amount + close_amount
         
-        print(f"\n数量统计:")
-        print(f"  开仓: {open_amount}")
-        print(f"  加仓: {add_amount}")
-        print(f"  减仓: {reduce_amount}")
-        print(f"  平仓: {close_amount}")
-        print(f"  总开仓: {total_open}")
-        print(f"  总平仓: {total_close}")
+        print(f"\n数量统计:", file=out)
+        print(f"  开仓: {open_amount}", file=out)
+        print(f"  加仓: {add_amount}", file=out)
+        print(f"  减仓: {reduce_amount}", file=out)
+        print(f"  平仓: {close_amount}", file=out)
+        print(f"  总开仓: {total_open}", file=out)
+        print(f"  总平仓: {total_close}", file=out)
         
         if total_open > 0:
             tolerance = abs(total_open * 0.01)
             if not self.float_compare(total_close, total_open, tolerance):
                 result['warnings'].append(f"数量不一致: 总开仓{total_open}, 总平仓{total_close}")
-                print(f"⚠ 数量不一致: 总开仓{total_open}, 总平仓{total_close}")
+                print(f"⚠ 数量不一致: 总开仓{total_open}, 总平仓{total_close}", file=out)
             else:
-                print(f"✓ 数量一致: 总开仓{total_open} = 总平仓{total_close}")
+                print(f"✓ 数量一致: 总开仓{total_open} = 总平仓{total_close}", file=out)
         
         if result['passed']:
-            print(f"\n✓ 场景{scenario_num} trading_relations 验证通过")
+            print(f"\n✓ 场景{scenario_num} trading_relations 验证通过", file=out)
         else:
-            print(f"\n✗ 场景{scenario_num} trading_relations 验证失败")
+            print(f"\n✗ 场景{scenario_num} trading_relations 验证失败", file=out)
         
         return result
     
@@ -438,8 +633,7 @@ class ExternalCloseTestVerifier:
         print(f"警告总数: {warning_count}")
         
         print(f"\n详细结果:")
-        for signal_id in sorted(self.step1_results.keys()):
-            result = self.step1_results[signal_id]
+        for signal_id, result in self._ordered_results(self.step1_results):
             status = "✓" if result['passed'] else "✗"
             print(f"{status} 场景{result['scenario_num']}: {result['scenario_name']} (signal_id={signal_id})")
             if result['errors']:
@@ -455,28 +649,43 @@ class ExternalCloseTestVerifier:
         print("第二步：order_history 表验证")
         print(f"{'='*60}")
         
-        for signal_id in sorted(self.test_scenarios.keys()):
-            scenario = self.test_scenarios[signal_id]
-            result = self._verify_order_history_scenario(signal_id, scenario)
-            self.step2_results[signal_id] = result
+        # trading_relations 复用第一步缓存，order_history 两次批量查询
+        tr_by_signal = self.get_cached_trading_relations(self._sorted_signal_ids)
+        cl_ord_ids = {
+            r.cl_ord_id for records in tr_by_signal.values() for r in records if r.cl_ord_id
+        }
+        orders_by_cl_ord_id = self.get_order_history_by_cl_ord_ids(cl_ord_ids)
+        orders_by_ord_id = self.get_order_history_by_signal_ids(self._sorted_signal_ids)
+        
+        self._run_scenarios(
+            lambda signal_id, scenario, out: self._verify_order_history_scenario(
+                signal_id, scenario, tr_by_signal[signal_id], orders_by_cl_ord_id, orders_by_ord_id, out
+            ),
+            self.step2_results
+        )
         
         # 汇总结果
         self._print_step2_summary()
     
-    def _verify_order_history_scenario(self, signal_id: int, scenario: Dict) -> Dict[str, Any]:
-        """验证单个场景的 order_history 数据"""
+    def _verify_order_history_scenario(
+        self,
+        signal_id: int,
+        scenario: Dict,
+        tr_records: List[TRRow],
+        orders_by_cl_ord_id: Dict[str, List[OrderRow]],
+        orders_by_ord_id: Dict[str, OrderRow],
+        out: io.StringIO
+    ) -> Dict[str, Any]:
+        """验证单个场景的 order_history 数据（输出写入 out 缓冲）"""
         scenario_name = scenario['name']
         scenario_num = scenario['scenario_num']
         symbol = scenario['symbol']
         side = scenario['side']
         
-        print(f"\n{'='*60}")
-        print(f"验证场景{scenario_num}: {scenario_name} (signal_id={signal_id})")
-        print(f"交易对: {symbol}, 方向: {side}")
-        print(f"{'='*60}")
-        
-        # 获取 trading_relations 记录
-        tr_records = self.get_trading_relations_by_signal_id(signal_id)
+        print(f"\n{'='*60}", file=out)
+        print(f"验证场景{scenario_num}: {scenario_name} (signal_id={signal_id})", file=out)
+        print(f"交易对: {symbol}, 方向: {side}", file=out)
+        print(f"{'='*60}", file=out)
         
         result = {
             'signal_id': signal_id,
@@ -495,32 +704,32 @@ class ExternalCloseTestVerifier:
         if len(tr_records) == 0:
             result['passed'] = False
             result['errors'].append("trading_relations 中没有记录，无法验证 order_history")
-            print(f"✗ trading_relations 中没有记录")
+            print(f"✗ trading_relations 中没有记录", file=out)
             return result
         
         # 获取 cl_ord_id
-        cl_ord_ids = set(r['cl_ord_id'] for r in tr_records if r['cl_ord_id'])
+        cl_ord_ids = set(r.cl_ord_id for r in tr_records if r.cl_ord_id)
         if len(cl_ord_ids) == 0:
             result['warnings'].append("所有记录的cl_ord_id为空，无法验证order_history")
-            print(f"⚠ 所有记录的cl_ord_id为空")
+            print(f"⚠ 所有记录的cl_ord_id为空", file=out)
             return result
         
         cl_ord_id = list(cl_ord_ids)[0]
-        print(f"cl_ord_id: {cl_ord_id}")
+        print(f"cl_ord_id: {cl_ord_id}", file=out)
         
         # 获取所有订单记录
-        all_orders = self.get_order_history_by_cl_ord_id(cl_ord_id)
+        all_orders = orders_by_cl_ord_id.get(cl_ord_id, [])
         result['total_orders'] = len(all_orders)
         
-        print(f"找到 {len(all_orders)} 条订单记录")
+        print(f"找到 {len(all_orders)} 条订单记录", file=out)
         
         # 1. 检查API操作的订单是否存在
-        api_tr_records = [r for r in tr_records if r['operation_type'] in ['open', 'add', 'reduce', 'close'] and r['ord_id']]
+        api_tr_records = [r for r in tr_records if r.operation_type in OPERATION_TYPES and r.ord_id]
         
         missing_ord_ids = []
         for tr_record in api_tr_records:
-            ord_id = tr_record['ord_id']
-            order = self.get_order_history_by_ord_id(ord_id)
+            ord_id = tr_record.ord_id
+            order = orders_by_ord_id.get(ord_id)
             
             if not order:
                 missing_ord_ids.append(ord_id)
@@ -528,112 +737,112 @@ class ExternalCloseTestVerifier:
                 error_msg = f"trading_relations中的ord_id={ord_id}在order_history中不存在"
                 result['errors'].append(error_msg)
                 result['missing_orders'].append(ord_id)
-                print(f"✗ {error_msg}")
+                print(f"✗ {error_msg}", file=out)
             else:
-                print(f"✓ 找到订单: ord_id={ord_id}")
+                print(f"✓ 找到订单: ord_id={ord_id}", file=out)
         
         if len(missing_ord_ids) == 0 and len(api_tr_records) > 0:
-            print(f"✓ 所有API操作的订单都已记录")
+            print(f"✓ 所有API操作的订单都已记录", file=out)
         
         # 2. 检查订单状态
         for order in all_orders:
-            ord_id = order['ord_id']
-            state = order['state']
+            ord_id = order.ord_id
+            state = order.state
             
             if state != 'filled':
                 result['warnings'].append(f"订单{ord_id}状态不是filled: {state}")
-                print(f"⚠ 订单{ord_id}状态: {state} (期望filled)")
+                print(f"⚠ 订单{ord_id}状态: {state} (期望filled)", file=out)
             else:
                 result['filled_orders'] += 1
         
         if result['filled_orders'] == len(all_orders) and len(all_orders) > 0:
-            print(f"✓ 所有订单状态都是filled: {result['filled_orders']}/{len(all_orders)}")
+            print(f"✓ 所有订单状态都是filled: {result['filled_orders']}/{len(all_orders)}", file=out)
         
         # 3. 检查数量转换正确性（合约数量 -> 币数量）
-        contract_size = self.get_contract_size(symbol)
-        print(f"\n合约乘数: {contract_size} ({symbol})")
+        contract_size = get_contract_size(symbol)
+        print(f"\n合约乘数: {contract_size} ({symbol})", file=out)
         
         for tr_record in tr_records:
-            if not tr_record['ord_id']:
+            if not tr_record.ord_id:
                 continue
             
-            order = self.get_order_history_by_ord_id(tr_record['ord_id'])
+            order = orders_by_ord_id.get(tr_record.ord_id)
             if not order:
                 continue
             
             # 订单的合约数量
-            order_sz = order['sz']  # 合约数量
+            order_sz = order.sz  # 合约数量
             # 转换为币数量
             order_amount_coins = order_sz * contract_size if contract_size > 0 else order_sz
             
             # trading_relations 中的币数量
-            tr_amount = tr_record['amount']
+            tr_amount = tr_record.amount
             
             if tr_amount is not None:
                 tolerance = abs(tr_amount * 0.01) if tr_amount > 0 else 0.01
                 if not self.float_compare(order_amount_coins, tr_amount, tolerance):
                     result['warnings'].append(
-                        f"数量转换不一致: ord_id={tr_record['ord_id']}, "
+                        f"数量转换不一致: ord_id={tr_record.ord_id}, "
                         f"order_history.sz={order_sz}(合约)={order_amount_coins}(币), "
                         f"trading_relations.amount={tr_amount}"
                     )
-                    print(f"⚠ 数量转换不一致: ord_id={tr_record['ord_id']}")
-                    print(f"   order_history: {order_sz}(合约) = {order_amount_coins}(币)")
-                    print(f"   trading_relations: {tr_amount}(币)")
+                    print(f"⚠ 数量转换不一致: ord_id={tr_record.ord_id}", file=out)
+                    print(f"   order_history: {order_sz}(合约) = {order_amount_coins}(币)", file=out)
+                    print(f"   trading_relations: {tr_amount}(币)", file=out)
                 else:
-                    print(f"✓ 数量转换正确: ord_id={tr_record['ord_id']}, {order_sz}(合约) = {order_amount_coins}(币) = {tr_amount}(币)")
+                    print(f"✓ 数量转换正确: ord_id={tr_record.ord_id}, {order_sz}(合约) = {order_amount_coins}(币) = {tr_amount}(币)", file=out)
         
         # 4. 检查订单的 cl_ord_id 关联
         for order in all_orders:
-            if order['cl_ord_id'] != cl_ord_id:
+            if order.cl_ord_id != cl_ord_id:
                 result['warnings'].append(
-                    f"订单{order['ord_id']}的cl_ord_id={order['cl_ord_id']}与期望的{cl_ord_id}不一致"
+                    f"订单{order.ord_id}的cl_ord_id={order.cl_ord_id}与期望的{cl_ord_id}不一致"
                 )
-                print(f"⚠ 订单{order['ord_id']}的cl_ord_id不一致")
+                print(f"⚠ 订单{order.ord_id}的cl_ord_id不一致", file=out)
             else:
-                print(f"✓ 订单{order['ord_id']}的cl_ord_id正确")
+                print(f"✓ 订单{order.ord_id}的cl_ord_id正确", file=out)
         
         # 5. 检查订单的 symbol 和 side
         expected_pos_side = 'long' if side == 'LONG' else 'short'
         for order in all_orders:
-            if order['symbol'].upper() != symbol.upper():
+            if order.symbol.upper() != symbol.upper():
                 result['warnings'].append(
-                    f"订单{order['ord_id']}的symbol={order['symbol']}与期望的{symbol}不一致"
+                    f"订单{order.ord_id}的symbol={order.symbol}与期望的{symbol}不一致"
                 )
-                print(f"⚠ 订单{order['ord_id']}的symbol不一致: {order['symbol']} vs {symbol}")
+                print(f"⚠ 订单{order.ord_id}的symbol不一致: {order.symbol} vs {symbol}", file=out)
             
-            if order.get('pos_side'):
-                if order['pos_side'] != expected_pos_side:
+            if order.pos_side:
+                if order.pos_side != expected_pos_side:
                     result['warnings'].append(
-                        f"订单{order['ord_id']}的pos_side={order['pos_side']}与期望的{expected_pos_side}不一致"
+                        f"订单{order.ord_id}的pos_side={order.pos_side}与期望的{expected_pos_side}不一致"
                     )
-                    print(f"⚠ 订单{order['ord_id']}的pos_side不一致: {order['pos_side']} vs {expected_pos_side}")
+                    print(f"⚠ 订单{order.ord_id}的pos_side不一致: {order.pos_side} vs {expected_pos_side}", file=out)
         
         # 6. 检查外部平仓的订单（如果已同步）
         external_tr_records = [
             r for r in tr_records 
-            if r['operation_type'] in ['reduce', 'close'] and r['ord_id']
+            if r.operation_type in CLOSE_OPERATION_TYPES and r.ord_id
         ]
         
         external_orders_found = 0
         for tr_record in external_tr_records:
-            ord_id = tr_record['ord_id']
-            order = self.get_order_history_by_ord_id(ord_id)
+            ord_id = tr_record.ord_id
+            order = orders_by_ord_id.get(ord_id)
             if order:
                 external_orders_found += 1
-                print(f"✓ 外部平仓订单已同步: ord_id={ord_id}")
+                print(f"✓ 外部平仓订单已同步: ord_id={ord_id}", file=out)
         
         if len(external_tr_records) > 0:
-            print(f"外部平仓订单同步情况: {external_orders_found}/{len(external_tr_records)}")
+            print(f"外部平仓订单同步情况: {external_orders_found}/{len(external_tr_records)}", file=out)
             if external_orders_found < len(external_tr_records):
                 result['warnings'].append(
                     f"部分外部平仓订单未同步: {external_orders_found}/{len(external_tr_records)}"
                 )
         
         if result['passed']:
-            print(f"\n✓ 场景{scenario_num} order_history 验证通过")
+            print(f"\n✓ 场景{scenario_num} order_history 验证通过", file=out)
         else:
-            print(f"\n✗ 场景{scenario_num} order_history 验证失败")
+            print(f"\n✗ 场景{scenario_num} order_history 验证失败", file=out)
         
         return result
     
@@ -659,8 +868,7 @@ class ExternalCloseTestVerifier:
         print(f"已成交订单: {filled_orders}")
         
         print(f"\n详细结果:")
-        for signal_id in sorted(self.step2_results.keys()):
-            result = self.step2_results[signal_id]
+        for signal_id, result in self._ordered_results(self.step2_results):
             status = "✓" if result['passed'] else "✗"
             print(f"{status} 场景{result['scenario_num']}: {result['scenario_name']} (signal_id={signal_id})")
             print(f"   订单数: {result['total_orders']}, 已成交: {result['filled_orders']}")
@@ -677,26 +885,52 @@ class ExternalCloseTestVerifier:
         print("第三步：数据一致性验证")
         print(f"{'='*60}")
         
-        for signal_id in sorted(self.test_scenarios.keys()):
-            scenario = self.test_scenarios[signal_id]
-            result = self._verify_consistency_scenario(signal_id, scenario)
-            self.step3_results[signal_id] = result
+        # 复用前两步的缓存；数量汇总单独运行时由数据库一次聚合
+        tr_by_signal = self.get_cached_trading_relations(self._sorted_signal_ids)
+        self.get_scenario_sums(self._sorted_signal_ids)
+        
+        # 两次批量查询预取所有场景的订单信息：已同步的平仓ord_id、按cl_ord_id汇总的订单统计
+        synced_ord_ids = self.get_existing_ord_ids([
+            r.ord_id for records in tr_by_signal.values() for r in records
+            if r.operation_type in CLOSE_OPERATION_TYPES and r.ord_id
+        ])
+        # 与场景验证一致，取每个场景记录中第一个非空cl_ord_id
+        stats_cl_ord_ids = []
+        for signal_id in self._sorted_signal_ids:
+            first_cl_ord_id = next((r.cl_ord_id for r in tr_by_signal[signal_id] if r.cl_ord_id), None)
+            if first_cl_ord_id is not None:
+                stats_cl_ord_ids.append(first_cl_ord_id)
+        order_stats = self.get_order_stats_bulk(stats_cl_ord_ids)
+        
+        self._run_scenarios(
+            lambda signal_id, scenario, out: self._verify_consistency_scenario(
+                signal_id, scenario, tr_by_signal[signal_id], synced_ord_ids, order_stats, out
+            ),
+            self.step3_results
+        )
         
         # 汇总结果
         self._print_step3_summary()
     
-    def _verify_consistency_scenario(self, signal_id: int, scenario: Dict) -> Dict[str, Any]:
-        """验证单个场景的数据一致性"""
+    def _verify_consistency_scenario(
+        self,
+        signal_id: int,
+        scenario: Dict,
+        tr_records: List[TRRow],
+        synced_ord_ids: Set[str],
+        order_stats: Dict[str, Tuple[int, float]],
+        out: io.StringIO
+    ) -> Dict[str, Any]:
+        """验证单个场景的数据一致性（数据由 step3_verify_consistency 预取，输出写入 out 缓冲）"""
         scenario_name = scenario['name']
         scenario_num = scenario['scenario_num']
         symbol = scenario['symbol']
         side = scenario['side']
-        steps = scenario['steps']
         
-        print(f"\n{'='*60}")
-        print(f"验证场景{scenario_num}: {scenario_name} (signal_id={signal_id})")
-        print(f"交易对: {symbol}, 方向: {side}")
-        print(f"{'='*60}")
+        print(f"\n{'='*60}", file=out)
+        print(f"验证场景{scenario_num}: {scenario_name} (signal_id={signal_id})", file=out)
+        print(f"交易对: {symbol}, 方向: {side}", file=out)
+        print(f"{'='*60}", file=out)
         
         result = {
             'signal_id': signal_id,
@@ -709,176 +943,166 @@ class ExternalCloseTestVerifier:
             'warnings': []
         }
         
-        # 获取 trading_relations 记录
-        tr_records = self.get_trading_relations_by_signal_id(signal_id)
-        
         if len(tr_records) == 0:
             result['passed'] = False
             result['errors'].append("trading_relations 中没有记录，无法验证数据一致性")
-            print(f"✗ trading_relations 中没有记录")
+            print(f"✗ trading_relations 中没有记录", file=out)
             return result
         
+        # 数量列和操作类型列转为数组，按操作类型向量化计数与求和（amount为空按0处理）
+        amounts = np.fromiter((r.amount or 0.0 for r in tr_records), dtype=np.float64, count=len(tr_records))
+        ops = np.array([r.operation_type for r in tr_records])
+        open_mask = ops == 'open'
+        add_mask = ops == 'add'
+        close_mask = np.isin(ops, tuple(CLOSE_OPERATION_TYPES))
+        open_count, add_count, close_count = int(open_mask.sum()), int(add_mask.sum()), int(close_mask.sum())
+        open_sum = float(amounts[open_mask].sum())
+        add_sum = float(amounts[add_mask].sum())
+        close_sum = float(amounts[close_mask].sum())
+        tr_total = float(amounts.sum())
+        
+        # 单次遍历收集有ord_id的平仓记录、第一个非空cl_ord_id、position_history 关联和最后一条记录
+        pos_history_count = cl_ord_id_count = 0
+        external_tr_records = []
+        first_cl_ord_id = last_tr_record = None
+        for r in tr_records:
+            last_tr_record = r
+            if r.ord_id and r.operation_type in CLOSE_OPERATION_TYPES:
+                external_tr_records.append(r)
+            if r.cl_ord_id:
+                cl_ord_id_count += 1
+                if first_cl_ord_id is None:
+                    first_cl_ord_id = r.cl_ord_id
+            if r.position_history_id:
+                pos_history_count += 1
+        
         # 1. 数量平衡验证
-        print(f"\n1. 数量平衡验证")
-        open_amount = sum(r['amount'] or 0 for r in tr_records if r['operation_type'] == 'open')
-        add_amount = sum(r['amount'] or 0 for r in tr_records if r['operation_type'] == 'add')
-        reduce_amount = sum(r['amount'] or 0 for r in tr_records if r['operation_type'] == 'reduce')
-        close_amount = sum(r['amount'] or 0 for r in tr_records if r['operation_type'] == 'close')
+        print(f"\n1. 数量平衡验证", file=out)
+        sums = self.get_scenario_sums([signal_id])[signal_id]
+        open_amount = sums['open']
+        add_amount = sums['add']
+        reduce_amount = sums['reduce']
+        close_amount = sums['close']
         
         total_open = open_amount + add_amount
         total_close = reduce_amount + close_amount
         final_position = total_open - total_close
         
-        print(f"  开仓: {open_amount}")
-        print(f"  加仓: {add_amount}")
-        print(f"  减仓: {reduce_amount}")
-        print(f"  平仓: {close_amount}")
-        print(f"  总开仓: {total_open}")
-        print(f"  总平仓: {total_close}")
-        print(f"  最终持仓: {final_position}")
+        # 订单统计：cl_ord_id 下的全部订单
+        order_count, order_total_sz = order_stats.get(first_cl_ord_id, (0, 0.0))
+        # order_history中的总数量：合约数量之和转换为币数量
+        contract_size = get_contract_size(symbol)
+        order_total_coins = order_total_sz * contract_size if contract_size > 0 else order_total_sz
+        
+        # 各项数量检查（最终持仓、开仓、加仓、平仓、订单总量）一次批量容差比较
+        balance_ok, open_ok, add_ok, close_ok, order_total_ok = batch_close(
+            np.array([final_position, open_sum, add_sum, close_sum, order_total_coins]),
+            np.array([0.0, open_amount, add_amount, total_close, tr_total]),
+            np.array([
+                abs(total_open * 0.01), 0.01, 0.01, 0.01,
+                abs(tr_total * 0.01) if tr_total > 0 else 0.01
+            ])
+        )
+        
+        print(f"  开仓: {open_amount}", file=out)
+        print(f"  加仓: {add_amount}", file=out)
+        print(f"  减仓: {reduce_amount}", file=out)
+        print(f"  平仓: {close_amount}", file=out)
+        print(f"  总开仓: {total_open}", file=out)
+        print(f"  总平仓: {total_close}", file=out)
+        print(f"  最终持仓: {final_position}", file=out)
         
         # 最终持仓应该为0（允许1%误差）
         if total_open > 0:
-            tolerance = abs(total_open * 0.01)
-            if not self.float_compare(final_position, 0.0, tolerance):
+            if not balance_ok:
                 result['passed'] = False
                 error_msg = f"数量不平衡: 最终持仓={final_position}, 期望=0 (总开仓={total_open}, 总平仓={total_close})"
                 result['errors'].append(error_msg)
-                print(f"✗ {error_msg}")
+                print(f"✗ {error_msg}", file=out)
             else:
-                print(f"✓ 数量平衡: 最终持仓={final_position} ≈ 0")
+                print(f"✓ 数量平衡: 最终持仓={final_position} ≈ 0", file=out)
         else:
             result['warnings'].append("总开仓为0，无法验证数量平衡")
-            print(f"⚠ 总开仓为0")
+            print(f"⚠ 总开仓为0", file=out)
         
         # 2. 验证开仓总数量 = 所有open操作的amount之和
-        print(f"\n2. 开仓总数量验证")
-        open_operations = [r for r in tr_records if r['operation_type'] == 'open']
-        open_sum = sum(r['amount'] or 0 for r in open_operations)
-        
-        if len(open_operations) > 0:
-            if self.float_compare(open_sum, open_amount):
-                print(f"✓ 开仓总数量正确: {open_sum}")
+        print(f"\n2. 开仓总数量验证", file=out)
+        if open_count > 0:
+            if open_ok:
+                print(f"✓ 开仓总数量正确: {open_sum}", file=out)
             else:
                 result['warnings'].append(f"开仓总数量不一致: 计算值={open_sum}, 汇总值={open_amount}")
-                print(f"⚠ 开仓总数量不一致")
+                print(f"⚠ 开仓总数量不一致", file=out)
         
         # 3. 验证加仓总数量 = 所有add操作的amount之和
-        print(f"\n3. 加仓总数量验证")
-        add_operations = [r for r in tr_records if r['operation_type'] == 'add']
-        add_sum = sum(r['amount'] or 0 for r in add_operations)
-        
-        if len(add_operations) > 0:
-            if self.float_compare(add_sum, add_amount):
-                print(f"✓ 加仓总数量正确: {add_sum}")
+        print(f"\n3. 加仓总数量验证", file=out)
+        if add_count > 0:
+            if add_ok:
+                print(f"✓ 加仓总数量正确: {add_sum}", file=out)
             else:
                 result['warnings'].append(f"加仓总数量不一致: 计算值={add_sum}, 汇总值={add_amount}")
-                print(f"⚠ 加仓总数量不一致")
+                print(f"⚠ 加仓总数量不一致", file=out)
         
         # 4. 验证平仓总数量 = 所有reduce+close操作的amount之和
-        print(f"\n4. 平仓总数量验证")
-        close_operations = [r for r in tr_records if r['operation_type'] in ['reduce', 'close']]
-        close_sum = sum(r['amount'] or 0 for r in close_operations)
-        
-        if len(close_operations) > 0:
-            if self.float_compare(close_sum, total_close):
-                print(f"✓ 平仓总数量正确: {close_sum}")
+        print(f"\n4. 平仓总数量验证", file=out)
+        if close_count > 0:
+            if close_ok:
+                print(f"✓ 平仓总数量正确: {close_sum}", file=out)
             else:
                 result['warnings'].append(f"平仓总数量不一致: 计算值={close_sum}, 汇总值={total_close}")
-                print(f"⚠ 平仓总数量不一致")
+                print(f"⚠ 平仓总数量不一致", file=out)
         
         # 5. 验证最后一条外部平仓必须为close
-        print(f"\n5. 最后一条外部平仓验证")
-        external_steps = [s for s in steps if s['step_type'] in ['外部部分平仓', '外部全部平仓']]
-        
-        if len(external_steps) > 0:
-            last_external_step = external_steps[-1]
-            last_tr_record = tr_records[-1]
-            
-            if last_external_step['step_type'] == '外部全部平仓':
-                if last_tr_record['operation_type'] == 'close':
-                    print(f"✓ 最后一条外部全部平仓正确识别为close")
-                else:
-                    result['passed'] = False
-                    error_msg = f"最后一条外部全部平仓应该为close，实际为{last_tr_record['operation_type']}"
-                    result['errors'].append(error_msg)
-                    print(f"✗ {error_msg}")
-            else:
-                print(f"✓ 最后一条是外部部分平仓，operation_type={last_tr_record['operation_type']}")
+        print(f"\n5. 最后一条外部平仓验证", file=out)
+        self._scenario_verifiers[signal_id](last_tr_record, result, out)
         
         # 6. 验证外部平仓的ord_id（如果订单已同步）
-        print(f"\n6. 外部平仓订单同步验证")
-        external_tr_records = [
-            r for r in tr_records 
-            if r['operation_type'] in ['reduce', 'close'] and r['ord_id']
-        ]
-        
+        print(f"\n6. 外部平仓订单同步验证", file=out)
         if len(external_tr_records) > 0:
-            external_orders_synced = 0
-            for tr_record in external_tr_records:
-                order = self.get_order_history_by_ord_id(tr_record['ord_id'])
-                if order:
-                    external_orders_synced += 1
+            external_orders_synced = sum(
+                1 for tr_record in external_tr_records if tr_record.ord_id in synced_ord_ids
+            )
             
-            print(f"  外部平仓记录数: {len(external_tr_records)}")
-            print(f"  已同步订单数: {external_orders_synced}")
+            print(f"  外部平仓记录数: {len(external_tr_records)}", file=out)
+            print(f"  已同步订单数: {external_orders_synced}", file=out)
             
             if external_orders_synced == len(external_tr_records):
-                print(f"✓ 所有外部平仓订单都已同步")
+                print(f"✓ 所有外部平仓订单都已同步", file=out)
             else:
                 result['warnings'].append(
                     f"部分外部平仓订单未同步: {external_orders_synced}/{len(external_tr_records)}"
                 )
-                print(f"⚠ 部分外部平仓订单未同步")
+                print(f"⚠ 部分外部平仓订单未同步", file=out)
         else:
-            print(f"  无外部平仓记录或ord_id为空")
+            print(f"  无外部平仓记录或ord_id为空", file=out)
         
         # 7. 验证trading_relations与order_history的数量一致性
-        print(f"\n7. trading_relations与order_history数量一致性验证")
-        cl_ord_ids = set(r['cl_ord_id'] for r in tr_records if r['cl_ord_id'])
-        
-        if len(cl_ord_ids) > 0:
-            cl_ord_id = list(cl_ord_ids)[0]
-            orders = self.get_order_history_by_cl_ord_id(cl_ord_id)
-            contract_size = self.get_contract_size(symbol)
-            
-            # 计算order_history中的总数量（币数量）
-            order_total_coins = 0
-            for order in orders:
-                order_sz = order['sz']  # 合约数量
-                order_amount_coins = order_sz * contract_size if contract_size > 0 else order_sz
-                order_total_coins += order_amount_coins
-            
-            # 计算trading_relations中的总数量
-            tr_total = sum(r['amount'] or 0 for r in tr_records if r['amount'] is not None)
-            
-            if len(orders) > 0:
-                tolerance = abs(tr_total * 0.01) if tr_total > 0 else 0.01
-                if self.float_compare(order_total_coins, tr_total, tolerance):
-                    print(f"✓ 数量一致性正确: order_history={order_total_coins}(币), trading_relations={tr_total}(币)")
+        print(f"\n7. trading_relations与order_history数量一致性验证", file=out)
+        if cl_ord_id_count > 0:
+            if order_count > 0:
+                if order_total_ok:
+                    print(f"✓ 数量一致性正确: order_history={order_total_coins}(币), trading_relations={tr_total}(币)", file=out)
                 else:
                     result['warnings'].append(
                         f"数量不一致: order_history={order_total_coins}(币), trading_relations={tr_total}(币)"
                     )
-                    print(f"⚠ 数量不一致: order_history={order_total_coins}(币), trading_relations={tr_total}(币)")
+                    print(f"⚠ 数量不一致: order_history={order_total_coins}(币), trading_relations={tr_total}(币)", file=out)
             else:
                 result['warnings'].append("order_history中没有订单记录")
-                print(f"⚠ order_history中没有订单记录")
+                print(f"⚠ order_history中没有订单记录", file=out)
         
         # 8. 验证position_history关联（可选）
-        print(f"\n8. position_history关联验证")
-        tr_with_pos_history = [r for r in tr_records if r['position_history_id']]
-        
-        if len(tr_with_pos_history) > 0:
-            print(f"  有position_history_id的记录数: {len(tr_with_pos_history)}")
-            print(f"  ✓ 部分记录已关联position_history")
+        print(f"\n8. position_history关联验证", file=out)
+        if pos_history_count > 0:
+            print(f"  有position_history_id的记录数: {pos_history_count}", file=out)
+            print(f"  ✓ 部分记录已关联position_history", file=out)
         else:
-            print(f"  无position_history关联（这是正常的，平仓后才会关联）")
+            print(f"  无position_history关联（这是正常的，平仓后才会关联）", file=out)
         
         if result['passed']:
-            print(f"\n✓ 场景{scenario_num} 数据一致性验证通过")
+            print(f"\n✓ 场景{scenario_num} 数据一致性验证通过", file=out)
         else:
-            print(f"\n✗ 场景{scenario_num} 数据一致性验证失败")
+            print(f"\n✗ 场景{scenario_num} 数据一致性验证失败", file=out)
         
         return result
     
@@ -899,8 +1123,7 @@ class ExternalCloseTestVerifier:
         print(f"警告总数: {warning_count}")
         
         print(f"\n详细结果:")
-        for signal_id in sorted(self.step3_results.keys()):
-            result = self.step3_results[signal_id]
+        for signal_id, result in self._ordered_results(self.step3_results):
             status = "✓" if result['passed'] else "✗"
             print(f"{status} 场景{result['scenario_num']}: {result['scenario_name']} (signal_id={signal_id})")
             if result['errors']:
@@ -925,65 +1148,62 @@ class ExternalCloseTestVerifier:
             # 第三步：数据一致性验证
             self.step3_verify_consistency()
             
-            # 最终汇总
-            self._print_final_summary()
+            # 最终汇总（各步骤统计只计算一次）
+            summary = self._compute_summary()
+            self._print_final_summary(summary)
             
             # 判断是否全部通过
-            step1_passed = sum(1 for r in self.step1_results.values() if r['passed'])
-            step1_total = len(self.step1_results)
-            step1_errors = sum(len(r['errors']) for r in self.step1_results.values())
-            
-            step2_passed = sum(1 for r in self.step2_results.values() if r['passed'])
-            step2_total = len(self.step2_results)
-            step2_errors = sum(len(r['errors']) for r in self.step2_results.values())
-            
-            step3_passed = sum(1 for r in self.step3_results.values() if r['passed'])
-            step3_total = len(self.step3_results)
-            step3_errors = sum(len(r['errors']) for r in self.step3_results.values())
-            
-            return (step1_passed == step1_total and step1_errors == 0 and 
-                    step2_passed == step2_total and step2_errors == 0 and
-                    step3_passed == step3_total and step3_errors == 0)
+            return self._all_passed(summary)
         
         finally:
             self.close()
     
-    def _print_final_summary(self):
+    def _compute_summary(self) -> Dict[str, Dict[str, int]]:
+        """统计各步骤的通过数、总数、错误数和警告数"""
+        summary = {}
+        for step, results in (
+            ('step1', self.step1_results),
+            ('step2', self.step2_results),
+            ('step3', self.step3_results),
+        ):
+            passed = errors = warnings = 0
+            for r in results.values():
+                passed += r['passed']
+                errors += len(r['errors'])
+                warnings += len(r['warnings'])
+            summary[step] = {'passed': passed, 'total': len(results), 'errors': errors, 'warnings': warnings}
+        return summary
+    
+    @staticmethod
+    def _all_passed(summary: Dict[str, Dict[str, int]]) -> bool:
+        """所有步骤全部通过且没有错误"""
+        return all(s['passed'] == s['total'] and s['errors'] == 0 for s in summary.values())
+    
+    def _print_final_summary(self, summary: Dict[str, Dict[str, int]]):
         """打印最终汇总"""
         print(f"\n{'='*60}")
         print("最终验证汇总")
         print(f"{'='*60}")
         
-        step1_passed = sum(1 for r in self.step1_results.values() if r['passed'])
-        step1_total = len(self.step1_results)
-        step1_errors = sum(len(r['errors']) for r in self.step1_results.values())
-        step1_warnings = sum(len(r['warnings']) for r in self.step1_results.values())
+        for step, title in (
+            ('step1', '第一步（trading_relations验证）'),
+            ('step2', '第二步（order_history验证）'),
+            ('step3', '第三步（数据一致性验证）'),
+        ):
+            s = summary[step]
+            print(f"{title}: {s['passed']}/{s['total']} 通过, {s['errors']} 个错误, {s['warnings']} 个警告")
         
-        step2_passed = sum(1 for r in self.step2_results.values() if r['passed'])
-        step2_total = len(self.step2_results)
-        step2_errors = sum(len(r['errors']) for r in self.step2_results.values())
-        step2_warnings = sum(len(r['warnings']) for r in self.step2_results.values())
-        
-        step3_passed = sum(1 for r in self.step3_results.values() if r['passed'])
-        step3_total = len(self.step3_results)
-        step3_errors = sum(len(r['errors']) for r in self.step3_results.values())
-        step3_warnings = sum(len(r['warnings']) for r in self.step3_results.values())
-        
-        print(f"第一步（trading_relations验证）: {step1_passed}/{step1_total} 通过, {step1_errors} 个错误, {step1_warnings} 个警告")
-        print(f"第二步（order_history验证）: {step2_passed}/{step2_total} 通过, {step2_errors} 个错误, {step2_warnings} 个警告")
-        print(f"第三步（数据一致性验证）: {step3_passed}/{step3_total} 通过, {step3_errors} 个错误, {step3_warnings} 个警告")
-        
-        all_passed = (step1_passed == step1_total and step1_errors == 0 and 
-                      step2_passed == step2_total and step2_errors == 0 and
-                      step3_passed == step3_total and step3_errors == 0)
-        
-        if all_passed:
+        if self._all_passed(summary):
             print("\n✓ 所有验证全部通过！")
         else:
             print("\n✗ 验证未完全通过")
 
-
 if __name__ == "__main__":
+    from dotenv import load_dotenv
+    
+    # 加载环境变量（作为库导入时由调用方负责）
+    load_dotenv()
+    
     print("="*60)
     print("外部平仓测试数据验证脚本")
     print("="*60)
@@ -993,7 +1213,7 @@ if __name__ == "__main__":
     try:
         verifier = ExternalCloseTestVerifier()
         print(f"✓ 加载测试场景配置: {len(verifier.test_scenarios)} 个场景")
-        for signal_id, scenario in sorted(verifier.test_scenarios.items()):
+        for signal_id, scenario in zip(verifier._sorted_signal_ids, verifier._scenarios_sorted):
             print(f"  场景{scenario['scenario_num']}: {scenario['name']} (signal_id={signal_id})")
         
         success = verifier.run()
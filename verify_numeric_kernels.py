@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""
+外部平仓验证脚本的数值内核
+批量容差比较：安装 numba 时编译为本地代码，未安装时使用 NumPy 实现
+"""
+import numpy as np
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:  # numba 为可选依赖
+    njit = None
+    NUMBA_AVAILABLE = False
+
+
+def _batch_close_numpy(a: np.ndarray, b: np.ndarray, atol: np.ndarray) -> np.ndarray:
+    """逐元素判断 |a - b| <= atol"""
+    return np.abs(a - b) <= atol
+
+
+if NUMBA_AVAILABLE:
+    @njit(cache=True)
+    def batch_close(a, b, atol):
+        """逐元素判断 |a - b| <= atol（numba 编译）"""
+        out = np.empty(a.shape[0], dtype=np.bool_)
+        for i in range(a.shape[0]):
+            out[i] = abs(a[i] - b[i]) <= atol[i]
+        return out
+else:
+    batch_close = _batch_close_numpy